@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser, Namespace
-from configparser import ConfigParser
+from configparser import ConfigParser, SectionProxy
 import fnmatch
+import functools
 import logging
 import logging.handlers
-import subprocess
+import os
+import re
 import sys
-from typing import Collection, List, Optional, Set
+import time
+from typing import Callable, Collection, Dict, Iterator, List, Optional, Set, Tuple
+
+import koji
 
 
 ERR_CONFIG = 3
@@ -21,6 +26,15 @@ CFG_SECTION = "kojicron"
 MB = 1 << 20
 LOG_MAX_SIZE = 500 * MB
 
+_GLOB_CHARS = re.compile(r"[*?[]")
+
+# What the koji library can raise for a failed call: koji exceptions,
+# plain XMLRPC faults for hub or task errors that koji has no exception
+# class for, and connection errors (requests' exceptions are OSErrors).
+_KOJI_ERRORS = (koji.GenericError, koji.Fault, OSError)
+
+_config_cache: Dict[str, Tuple[int, ConfigParser]] = {}
+
 _debug = False
 _log = logging.getLogger(__name__)
 
@@ -56,71 +70,110 @@ class ConfigError(ProgramError):
         return f"Config error: {super().__str__()}"
 
 
+@functools.lru_cache(maxsize=32)
+def make_tag_matcher(patterns: Tuple[str, ...]) -> Callable[[str], bool]:
+    """
+    Build a function that returns True if a tag matches at least one of
+    the given glob patterns.  Matchers are cached, so the globs are only
+    translated and compiled once for a given set of patterns.
+
+    Globs without wildcards, and globs whose only wildcard is a single
+    leading or trailing "*", are checked with a set lookup or
+    str.startswith/str.endswith; the rest are translated into a single
+    regex so each tag is matched against all of them at once.  Tags
+    that can't start with any of the regex globs' literal prefixes
+    skip the regex.
+    """
+    literals = set()
+    prefixes = []
+    suffixes = []
+    complex_patterns = []
+    for pattern in patterns:
+        if not _GLOB_CHARS.search(pattern):
+            literals.add(pattern)
+        elif pattern.endswith("*") and not _GLOB_CHARS.search(pattern[:-1]):
+            prefixes.append(pattern[:-1])
+        elif pattern.startswith("*") and not _GLOB_CHARS.search(pattern[1:]):
+            suffixes.append(pattern[1:])
+        else:
+            complex_patterns.append(pattern)
+    prefixes_t = tuple(prefixes)
+    suffixes_t = tuple(suffixes)
+    if complex_patterns:
+        regex_match = re.compile(
+            "|".join(f"(?:{fnmatch.translate(p)})" for p in complex_patterns)
+        ).match
+        # If every regex glob starts with some literal text, a tag can
+        # only match if its first few characters are one of those
+        # prefixes; check that before running the regex.
+        literal_prefixes = [_GLOB_CHARS.split(p, 1)[0] for p in complex_patterns]
+        if all(literal_prefixes):
+            prefix_len = min(len(lp) for lp in literal_prefixes)
+            regex_prefixes = {lp[:prefix_len] for lp in literal_prefixes}
+        else:
+            # tag[:0] is always "", so this lets every tag through
+            prefix_len = 0
+            regex_prefixes = {""}
+    else:
+        regex_match = None
+
+    def matches(tag: str) -> bool:
+        return (
+            tag in literals
+            or tag.startswith(prefixes_t)
+            or tag.endswith(suffixes_t)
+            or (
+                regex_match is not None
+                and tag[:prefix_len] in regex_prefixes
+                and regex_match(tag) is not None
+            )
+        )
+
+    return matches
+
+
 class KojiCron:
     """
-    A class for interacting with Koji via the cli.
+    A class for interacting with Koji via its Python API.
 
-    The koji cli gets params for which server to contact, how to auth
+    The koji library gets params for which server to contact, how to auth
     to the server, etc., from a config file; also, we can tell it what
-    section of the config file to take options from.
+    section of the config file to take options from.  A single session
+    is used (and authenticated once) for every call to the hub.
 
     Args:
-        config_path: Path to the config file koji commands will use
-        config_section: The section of the config file koji commands
-            will use
+        config_path: Path to the config file koji will use
+        config_section: The section of the config file koji will use
+
+    Raises:
+        ConfigError: if koji can't read its options from the config file
     """
 
     def __init__(self, config_path: str, config_section: str):
         self.config_path = config_path
         self.config_section = config_section
-        self._koji_cmd_base = [
-            "koji",
-            "-q",
-            "--config=" + self.config_path,
-            "--profile=" + self.config_section,
-        ]
-
-    def koji(self, *args, **kwargs):
-        """
-        A wrapper around `subprocess.run` that runs `koji` with
-        the arguments for the right config file and config section.
-
-        Args:
-            *args: same as subprocess.run()
-            **kwargs: same as subprocess.run()
-
-        Returns:
-            same as subprocess.run()
-        """
-        kwargs.setdefault("stdout", subprocess.PIPE)
-        kwargs.setdefault("stderr", subprocess.PIPE)
-        kwargs.setdefault("encoding", "latin-1")
-
-        cmd = self._koji_cmd_base + list(args)
-
-        if _debug:
-            _log.debug("running %r %r", cmd, kwargs)
-
-        return subprocess.run(
-            cmd,
-            **kwargs,
+        try:
+            self.opts = koji.read_config(config_section, user_config=config_path)
+        except koji.ConfigurationError as e:
+            raise ConfigError(str(e))
+        self.session = koji.ClientSession(
+            self.opts["server"],
+            koji.grab_session_options(self.opts),
         )
 
-    def get_tag_list(self) -> List[str]:
+    def get_tag_list(self) -> Iterator[str]:
         """
-        Return a list of tags available in Koji
+        Return an iterator over the names of the tags available in Koji
         Raises: KojiError if we can't talk to Koji.
         """
-        ret = self.koji("--noauth", "list-tags")
-        if ret.returncode != 0:
+        try:
+            tag_infos = self.session.listTags()
+        except _KOJI_ERRORS as e:
             raise KojiError(
                 ERR_CANT_GET_TAG_LIST,
-                f"Return code {ret.returncode} getting tag list from server.\n"
-                f"Stdout:\n{ret.stdout}\n"
-                f"Stderr:\n{ret.stderr}",
+                f"Error getting tag list from server: {e}",
             )
-        tags = ret.stdout.splitlines()
-        return tags
+        return (tag_info["name"] for tag_info in tag_infos)
 
     def get_tags_to_regen(self, included_tags: Collection[str]) -> Set[str]:
         """
@@ -137,27 +190,59 @@ class KojiCron:
         """
         if isinstance(included_tags, str):
             included_tags = [included_tags]
-        tags = self.get_tag_list()
-        tags_to_regen = set()
-        for pattern in included_tags:
-            tags_to_regen.update(fnmatch.filter(tags, pattern))
+        if not included_tags:
+            return set()
+        # drop duplicate globs; a tag stops being checked at its first match
+        matches = make_tag_matcher(tuple(dict.fromkeys(included_tags)))
+        tags_to_regen = {tag for tag in self.get_tag_list() if matches(tag)}
         return tags_to_regen
 
     def verify_auth(self) -> None:
-        """Test if authentication to Koji works; raise KojiError if not."""
-        ret = self.koji("hello")
-        if ret.returncode != 0:
+        """
+        Authenticate the session to Koji; raise KojiError if it fails.
+        Does nothing if the session is already logged in, so this can be
+        called before any call that needs authentication.
+        """
+        if self.session.logged_in:
+            return
+        try:
+            if self.opts["authtype"] == "ssl":
+                self.session.ssl_login(self.opts["cert"], None, self.opts["serverca"])
+            else:
+                self.session.gssapi_login(
+                    principal=self.opts["principal"],
+                    keytab=self.opts["keytab"],
+                )
+        except _KOJI_ERRORS as e:
             raise KojiError(
                 ERR_CANT_AUTH_TO_KOJI,
-                f"Return code {ret.returncode} authenticating to Koji.\n"
-                f"Stdout:\n{ret.stdout}\n"
-                f"Stderr:\n{ret.stderr}",
+                f"Error authenticating to Koji: {e}",
             )
+        if not self.session.logged_in:
+            raise KojiError(ERR_CANT_AUTH_TO_KOJI, "Unable to log in to Koji")
+
+    def wait_for_task(self, task_id: int) -> None:
+        """
+        Poll Koji until a task is finished.
+
+        Raises:
+            koji.GenericError or koji.Fault: if the task failed or was
+                canceled
+        """
+        while not self.session.taskFinished(task_id):
+            time.sleep(self.opts["poll_interval"])
+        # getTaskResult raises the task's error if it didn't succeed
+        self.session.getTaskResult(task_id)
 
     def regen_a_tag(self, tag: str, wait: bool) -> bool:
         """
         Runs regen-repo on a single tag.
 
+        This always starts a new newRepo task, like
+        `koji regen-repo --make-task`.  Against a 1.35+ hub, plain
+        `koji regen-repo` makes a repo request instead, which may reuse
+        a repo that is already current; we deliberately regenerate.
+
         Args:
             tag: the tag to regen
             wait: whether to wait for regen-repo to complete
@@ -171,33 +256,70 @@ class KojiCron:
 
         if wait:
             _log.info("Launching regen-repo for tag %s", tag)
-            ret = self.koji("regen-repo", "--wait", tag)
         else:
             _log.info("Queueing regen-repo for tag %s", tag)
-            ret = self.koji("regen-repo", "--nowait", tag)
-        if ret.returncode != 0:
-            _log.error(
-                "Return code %d doing regen-repo %s.\nStdout:\n%s\nStderr:\n%s",
-                ret.returncode,
-                tag,
-                ret.stdout,
-                ret.stderr,
-            )
+        try:
+            task_id = self.session.newRepo(tag)
+            if wait:
+                self.wait_for_task(task_id)
+        except _KOJI_ERRORS as e:
+            _log.error("Error doing regen-repo %s: %s", tag, e)
             return False
         else:
-            _log.debug(
-                "regen-repo %s succeeded.\nStdout:\n%s\nStderr:\n%s",
-                tag,
-                ret.stdout,
-                ret.stderr,
-            )
+            _log.debug("regen-repo %s succeeded (task %d)", tag, task_id)
             return True
 
+    def queue_tags(
+        self,
+        tags_to_regen: Collection[str],
+        batch_size: Optional[int] = None,
+    ) -> Set[str]:
+        """
+        Queues regen-repo on several tags at once, without waiting for
+        the regens to complete.  The newRepo calls are sent to the hub
+        in a single multicall, or in chunks of `batch_size` calls.  As in
+        regen_a_tag(), every tag gets a new newRepo task.
+
+        Args:
+            tags_to_regen: the tags to regen
+            batch_size: the maximum number of calls per request to the
+                hub; None or 0 means no limit
+
+        Returns:
+            The set of tags we couldn't queue a regen-repo for
+        """
+        for tag in tags_to_regen:
+            _log.info("Queueing regen-repo for tag %s", tag)
+        mc = self.session.multicall(batch=batch_size or None)
+        calls = {tag: mc.newRepo(tag) for tag in tags_to_regen}
+        try:
+            mc.call_all()
+        except _KOJI_ERRORS as e:
+            # With batch_size, earlier batches may already have been
+            # queued; calls that were never sent raise MultiCallNotReady
+            # below, so only those are counted as failed.
+            _log.error("Error doing regen-repo multicall: %s", e)
+
+        failed_tags = set()
+        for tag, call in calls.items():
+            try:
+                task_id = call.result
+            except koji.MultiCallNotReady:
+                _log.error("regen-repo %s was not sent to the hub", tag)
+                failed_tags.add(tag)
+            except _KOJI_ERRORS as e:
+                _log.error("Error doing regen-repo %s: %s", tag, e)
+                failed_tags.add(tag)
+            else:
+                _log.debug("regen-repo %s succeeded (task %d)", tag, task_id)
+        return failed_tags
+
     def regen_tags(
         self,
         tags_to_regen: Collection[str],
         continue_on_failure: bool,
         wait: bool,
+        batch_size: Optional[int] = None,
     ) -> Set[str]:
         """
         Regen one or more tags.
@@ -205,34 +327,46 @@ class KojiCron:
         Args:
             tags_to_regen: the tags to regen; tags must exist in Koji
             continue_on_failure: on failure, continue with the
-                remaining tags instead of bailing out immediately
+                remaining tags instead of bailing out immediately;
+                if `wait` is False, all the tags are queued at once,
+                so this only affects whether failures raise KojiError
             wait: wait for each tag to be regenerated before starting
                 the next
+            batch_size: if `wait` is False, the maximum number of tags
+                to queue per request to the hub; None or 0 means no limit
 
         Returns:
             The set of tags we couldn't regenerate
 
         Raises:
-            KojiError: if we couldn't regen a tag and
-                continue_on_failure is False
+            KojiError: if we couldn't authenticate to Koji, or if we
+                couldn't regen a tag and continue_on_failure is False
         """
         if isinstance(tags_to_regen, str):
             tags_to_regen = [tags_to_regen]
+        # regen in a fixed order so runs are reproducible
+        tags_to_regen = sorted(set(tags_to_regen))
+        self.verify_auth()
+        if not wait:
+            failed_tags = self.queue_tags(tags_to_regen, batch_size)
+            if failed_tags and not continue_on_failure:
+                raise KojiError(
+                    ERR_CANT_REGEN_REPO,
+                    f"Error doing regen-repo on tag(s): {sorted(failed_tags)}",
+                )
+            return failed_tags
+
         failed_tags = set()
-        remaining_tags_to_regen = set(tags_to_regen)
-        # doing a while loop instead of iteration to keep track of the remaining tags
-        while remaining_tags_to_regen:
-            tag = remaining_tags_to_regen.pop()
+        for idx, tag in enumerate(tags_to_regen):
             ok = self.regen_a_tag(tag, wait)
             if not ok:
                 if not continue_on_failure:
                     raise KojiError(
                         ERR_CANT_REGEN_REPO,
-                        f"Error doing regen-repo {tag}.  Remaining tags: {remaining_tags_to_regen}",
+                        f"Error doing regen-repo {tag}.  Remaining tags: {tags_to_regen[idx + 1:]}",
                     )
                 _log.info("Continuing")
                 failed_tags.add(tag)
-        # end while
         return failed_tags
 
 
@@ -247,18 +381,20 @@ def validate_config(config: ConfigParser) -> None:
         if not kcconfig.get(required_option):
             raise ConfigError(f"{required_option} not provided or empty")
 
-    if not kcconfig["server"].startswith("https://"):
+    server = kcconfig["server"]
+    if not server.startswith("https://"):
         raise ConfigError("server is not an HTTPS URL")
-    if not kcconfig["server"].endswith("/kojihub"):
+    if not server.endswith("/kojihub"):
         raise ConfigError("server is not a koji-hub XMLRPC endpoint (/kojihub)")
 
-    if kcconfig["authtype"] == "ssl":
+    authtype = kcconfig["authtype"]
+    if authtype == "ssl":
         if not kcconfig.get("cert"):
             raise ConfigError(
                 "cert not provided or empty for ssl authtype; "
                 "specify cert or switch to gssapi authtype"
             )
-    elif kcconfig["authtype"] == "gssapi":
+    elif authtype == "gssapi":
         if not kcconfig.get("principal"):
             raise ConfigError(
                 "principal not provided or empty for gssapi authtype; "
@@ -267,17 +403,49 @@ def validate_config(config: ConfigParser) -> None:
     else:
         raise ConfigError("authtype is not 'ssl' or 'gssapi'")
 
+    try:
+        batch_size = kcconfig.getint("batch_size", fallback=0)
+    except ValueError:
+        raise ConfigError("'batch_size' must be an integer")
+    if batch_size < 0:
+        raise ConfigError("'batch_size' must not be negative")
+
 
-def get_boolean_option(name: str, args: Namespace, config: ConfigParser) -> bool:
+def read_config(config_path: str) -> ConfigParser:
     """
-    Gets the value of a boolean config file option, which can also be
-    turned on by a command-line argument of the same name.
+    Read and validate the config file; raise ConfigError if validation
+    fails.  The parsed config is cached until the file's mtime changes,
+    so reading an unchanged file again skips the ConfigParser parse and
+    validate_config().  This does not cover koji's own reading of the
+    file when a KojiCron is created.
+    """
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _config_cache.get(config_path)
+    if mtime is not None and cached and cached[0] == mtime:
+        return cached[1]
+
+    config = ConfigParser()
+    config.read(config_path)
+    validate_config(config)
+    if mtime is not None:
+        _config_cache[config_path] = (mtime, config)
+    return config
+
+
+def get_boolean_option(name: str, args: Namespace, kcconfig: SectionProxy) -> bool:
+    """
+    Gets the value of a boolean option from the kojicron section of the
+    config file, which can also be turned on by a command-line argument
+    of the same name.
     Raise ConfigError if the option is not a boolean.
     """
     try:
         cmdarg = getattr(args, name, None)
         if cmdarg is None:
-            return config[CFG_SECTION].getboolean(name, fallback=False)
+            return kcconfig.getboolean(name, fallback=False)
         else:
             return bool(cmdarg)
     except ValueError:
@@ -380,15 +548,15 @@ def main(argv: Optional[List[str]] = None) -> int:
     args = parse_command_line(argv or sys.argv)
     config_path: str = args.config
 
-    config = ConfigParser()
-    config.read(config_path)
-    validate_config(config)
+    config = read_config(config_path)
+    kcconfig = config[CFG_SECTION]
 
-    _debug = get_boolean_option("debug", args, config)
+    _debug = get_boolean_option("debug", args, kcconfig)
     dry_run: bool = args.dry_run
-    wait = get_boolean_option("wait", args, config)
-    continue_on_failure = get_boolean_option("continue_on_failure", args, config)
-    included_tags = config[CFG_SECTION]["included_tags"].split()
+    wait = get_boolean_option("wait", args, kcconfig)
+    continue_on_failure = get_boolean_option("continue_on_failure", args, kcconfig)
+    included_tags = kcconfig["included_tags"].split()
+    batch_size = kcconfig.getint("batch_size", fallback=0)
 
     setup_logging(args, config)
     kojicron = KojiCron(config_path, config_section=CFG_SECTION)
@@ -412,7 +580,9 @@ def main(argv: Optional[List[str]] = None) -> int:
         print("Would regen the following tags:\n" + "\n".join(sorted(tags_to_regen)))
 
     else:
-        failed_tags = kojicron.regen_tags(tags_to_regen, continue_on_failure, wait)
+        failed_tags = kojicron.regen_tags(
+            tags_to_regen, continue_on_failure, wait, batch_size
+        )
 
         if failed_tags:
             raise ProgramError(